@@ -1,97 +1,240 @@
 from argparse import ArgumentParser
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
 import mimetypes
+import os
 from pathlib import Path
-from typing import Callable, NamedTuple
+import sys
+from typing import Callable, Iterator, NamedTuple
 import time
 
 import imagehash as ih
+import numpy as np
 from PIL import Image
+import scipy.fft
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 
-HASH_FUNCS: dict[str, ih.ImageHash] = {
-    "phash": ih.phash,
-    "ahash": ih.average_hash,
-    "dhash": ih.dhash,
-    "whash": ih.whash,
+class HashFunc(NamedTuple):
+    # turns a single image into the array that its hash is computed from
+    prepare: Callable[[Image.Image], np.ndarray]
+    # turns the prepared arrays of a batch of images into uint64 hashes
+    finish: Callable[[list[np.ndarray]], np.ndarray]
+    # smallest size the hash needs, lets JPEGs be decoded at a reduced scale
+    draft_size: tuple[int, int] | None = None
+
+
+def _pack_hashes(bits: np.ndarray) -> np.ndarray:
+    # each row of 64 booleans becomes one big-endian uint64, as imagehash does
+    return np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+
+
+def _phash_pixels(img: Image.Image) -> np.ndarray:
+    return np.asarray(img.convert("L").resize((32, 32), Image.Resampling.LANCZOS))
+
+
+def _phash_bits(pixels: list[np.ndarray]) -> np.ndarray:
+    """
+    Same steps as imagehash.phash, but with one DCT call for the whole batch.
+    """
+    dct = scipy.fft.dctn(np.stack(pixels), axes=(1, 2))
+    low_freq = dct[:, :8, :8].reshape(len(pixels), -1)
+    return _pack_hashes(low_freq > np.median(low_freq, axis=1, keepdims=True))
+
+
+def _ahash_pixels(img: Image.Image) -> np.ndarray:
+    return np.asarray(img.convert("L").resize((8, 8), Image.Resampling.LANCZOS))
+
+
+def _ahash_bits(pixels: list[np.ndarray]) -> np.ndarray:
+    """
+    Same steps as imagehash.average_hash, for the whole batch at once.
+    """
+    flat = np.stack(pixels).reshape(len(pixels), -1)
+    return _pack_hashes(flat > flat.mean(axis=1, keepdims=True))
+
+
+def _dhash_pixels(img: Image.Image) -> np.ndarray:
+    return np.asarray(img.convert("L").resize((9, 8), Image.Resampling.LANCZOS))
+
+
+def _dhash_bits(pixels: list[np.ndarray]) -> np.ndarray:
+    """
+    Same steps as imagehash.dhash, for the whole batch at once.
+    """
+    stacked = np.stack(pixels)
+    diff = stacked[:, :, 1:] > stacked[:, :, :-1]
+    return _pack_hashes(diff.reshape(len(pixels), -1))
+
+
+def _imagehash_bits(
+    img: Image.Image, hash_func: Callable[[Image.Image], ih.ImageHash]
+) -> np.ndarray:
+    # pack the boolean hash array straight into an int rather than going
+    # through its hex string
+    return np.packbits(hash_func(img).hash).view(">u8")
+
+
+def _concat_hashes(hashes: list[np.ndarray]) -> np.ndarray:
+    return np.concatenate(hashes).astype(np.uint64)
+
+
+HASH_FUNCS: dict[str, HashFunc] = {
+    "phash": HashFunc(_phash_pixels, _phash_bits, draft_size=(32, 32)),
+    "ahash": HashFunc(_ahash_pixels, _ahash_bits, draft_size=(8, 8)),
+    "dhash": HashFunc(_dhash_pixels, _dhash_bits, draft_size=(9, 8)),
+    "whash": HashFunc(partial(_imagehash_bits, hash_func=ih.whash), _concat_hashes),
 }
 
+# the extensions mimetypes would call images, so the walk needs no guess_type()
+mimetypes.init()
+IMAGE_EXTS = frozenset(
+    ext.lower()
+    for ext, type_ in mimetypes.types_map.items()
+    if type_.startswith("image/")
+)
 
-@dataclass(slots=True)
-class HashResult:
-    hash_str: str
-    file_name: str
+BATCH_SIZE = 64
+TILE_SIZE = 2048
 
-    def __sub__(self, other: "HashResult") -> int:
-        return ih.hex_to_hash(self.hash_str) - ih.hex_to_hash(other.hash_str)
 
+def iter_images(source: Path, recursive: bool) -> Iterator[str]:
+    # walk with an explicit stack; DirEntry caches the file type from readdir
+    stack: list[str | Path] = [source]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if recursive is True:
+                        stack.append(entry.path)
+                    continue
+
+                if not entry.is_file():
+                    continue
+
+                if os.path.splitext(entry.name)[1].lower() in IMAGE_EXTS:
+                    yield entry.path
+
+
+def _batched(paths: Iterator[str], size: int) -> Iterator[list[str]]:
+    while batch := list(islice(paths, size)):
+        yield batch
+
+
+def _hash_batch(paths: list[str], hash_func: HashFunc) -> tuple[np.ndarray, list[str]]:
+    prepared: list[np.ndarray] = []
+    names: list[str] = []
+    for path in paths:
+        with Image.open(path) as img:
+            if hash_func.draft_size is not None:
+                # JPEGs are decoded straight to grayscale at 1/2, 1/4 or 1/8
+                # scale, other formats ignore this
+                img.draft("L", hash_func.draft_size)
 
-def get_hashes(
-    source: Path,
-    recursive: bool,
-    hash_func: Callable[[Image.Image], ih.ImageHash],
-) -> list[HashResult]:
-    hash_results: list[HashResult] = []
-
-    if not source.is_dir():
-        return hashes
-
-    for f in source.iterdir():
-        if recursive is True and f.is_dir():
-            hash_results.extend(
-                get_hashes(
-                    source=f,
-                    recursive=recursive,
-                    hash_func=hash_func,
-                )
-            )
-
-        if not f.is_file():
-            continue
-
-        mimetype, _ = mimetypes.guess_type(f)
-        if not mimetype or not mimetype.startswith("image"):
-            continue
-
-        with Image.open(f) as img:
             try:
-                img_hash = hash_func(img)
+                prepared.append(hash_func.prepare(img))
             except Exception as e:
-                print(f"Error processing {f}: {e}")
+                print(f"Error processing {path}: {e}")
                 continue
 
-            hash_results.append(HashResult(hash_str=str(img_hash), file_name=f.name))
+        names.append(os.path.basename(path))
 
-    return hash_results
+    if not prepared:
+        return np.empty(0, dtype=np.uint64), names
 
+    return hash_func.finish(prepared), names
+
+
+def get_hashes(
+    source: Path,
+    recursive: bool,
+    hash_func: HashFunc,
+) -> tuple[np.ndarray, list[str]]:
+    """
+    Return the hashes as a uint64 array alongside a list of file names,
+    where names[i] is the file that hashes[i] belongs to.
+    """
+    hashes: list[np.ndarray] = []
+    names: list[str] = []
+
+    # decoding and hashing is CPU bound, so spread it across all cores.
+    # map() submits batches as the walk yields them, so the workers start on
+    # the first batches while the scan goes on, but the scan still runs to
+    # completion before any results are collected.
+    with ProcessPoolExecutor() as executor:
+        results = executor.map(
+            partial(_hash_batch, hash_func=hash_func),
+            _batched(iter_images(source, recursive), BATCH_SIZE),
+        )
+        for batch_hashes, batch_names in results:
+            hashes.append(batch_hashes)
+            names.extend(batch_names)
+
+    if not hashes:
+        return np.empty(0, dtype=np.uint64), names
+
+    return np.concatenate(hashes), names
 
-def get_duplicates(
-    hash_results: list[HashResult], hamming_distance: int = 0
-) -> set[frozenset[Path]]:
-    print("sorting hashes...")
-    hash_results.sort(key=lambda x: x.hash_str)
-    stack: list[HashResult] = []
-    duplicates: set[frozenset[str]] = set()
 
+def _get_near_labels(hashes: np.ndarray, hamming_distance: int) -> list[int]:
+    rows: list[np.ndarray] = []
+    cols: list[np.ndarray] = []
+
+    # compare every pair of hashes, one tile of the distance matrix at a time,
+    # reusing the same buffers for every tile
+    size = min(TILE_SIZE, len(hashes))
+    xor_buf = np.empty((size, size), dtype=np.uint64)
+    dist_buf = np.empty((size, size), dtype=np.uint8)
+    match_buf = np.empty((size, size), dtype=np.bool_)
+
+    for i in range(0, len(hashes), TILE_SIZE):
+        row_hashes = hashes[i : i + TILE_SIZE]
+        for j in range(i, len(hashes), TILE_SIZE):
+            col_hashes = hashes[j : j + TILE_SIZE]
+            xor = xor_buf[: len(row_hashes), : len(col_hashes)]
+            dist = dist_buf[: len(row_hashes), : len(col_hashes)]
+            match = match_buf[: len(row_hashes), : len(col_hashes)]
+
+            np.bitwise_xor(row_hashes[:, None], col_hashes[None, :], out=xor)
+            np.bitwise_count(xor, out=dist)
+            np.less_equal(dist, hamming_distance, out=match)
+            a, b = np.nonzero(match)
+            rows.append(a + i)
+            cols.append(b + j)
+
+    # each group of duplicates is a connected component of the match graph
+    row_idx = np.concatenate(rows) if rows else np.empty(0, dtype=np.intp)
+    col_idx = np.concatenate(cols) if cols else np.empty(0, dtype=np.intp)
+    graph = coo_matrix(
+        (np.ones(len(row_idx), dtype=np.bool_), (row_idx, col_idx)),
+        shape=(len(hashes), len(hashes)),
+    )
+    _, labels = connected_components(graph.tocsr(), directed=False)
+    return labels.tolist()
+
+
+def get_duplicates(
+    hashes: np.ndarray, names: list[str], hamming_distance: int = 0
+) -> set[frozenset[str]]:
     print("finding duplicates...")
-    for result in hash_results:
-        if not stack:
-            stack.append(result)
-            continue
-
-        if stack[-1] - result < hamming_distance:
-            stack.append(result)
-        else:
-            if len(stack) > 1:
-                print(f"found duplicates: {len(stack)}")
-                duplicates.add(frozenset(item.file_name for item in stack))
-            stack.clear()
-            stack.append(result)
-
-    # check for duplicates at the end of the list
-    if len(stack) > 1:
-        print(f"found duplicates: {len(stack)}")
-        duplicates.add(frozenset(item.file_name for item in stack))
+    if hamming_distance == 0:
+        # exact matches only need a sort, not a pairwise scan
+        _, labels = np.unique(hashes, return_inverse=True)
+        labels = labels.tolist()
+    else:
+        labels = _get_near_labels(hashes, hamming_distance)
+
+    groups: dict[int, list[str]] = {}
+    for label, name in zip(labels, names):
+        groups.setdefault(label, []).append(name)
+
+    duplicates: set[frozenset[str]] = set()
+    for group in groups.values():
+        if len(group) > 1:
+            print(f"found duplicates: {len(group)}")
+            duplicates.add(frozenset(group))
 
     return duplicates
 
@@ -105,20 +248,22 @@ if __name__ == "__main__":
 
     ns = parser.parse_args()
 
+    if not ns.src.is_dir():
+        parser.error("Source must be a directory.")
+
     start = time.time()
 
     print("getting hashes...")
-    hashes = get_hashes(
+    hashes, names = get_hashes(
         source=ns.src,
         recursive=ns.recursive,
         hash_func=HASH_FUNCS[ns.hash],
     )
 
-    from pympler import asizeof
-
-    print(f"size of hashes: {asizeof.asizeof(hashes)}")
+    names_size = sys.getsizeof(names) + sum(sys.getsizeof(n) for n in names)
+    print(f"size of hashes: {hashes.nbytes + names_size}")
 
-    duplicates = get_duplicates(hashes, ns.hamming_distance)
+    duplicates = get_duplicates(hashes, names, ns.hamming_distance)
 
     end = time.time()
     print(f"""Ran in {end - start:.2f} seconds""")
@@ -1,7 +1,10 @@
 from argparse import ArgumentParser
 from datetime import datetime
+import io
 import mimetypes
+import os
 from pathlib import Path
+from typing import BinaryIO, Iterator
 
 from PIL import Image, ExifTags as exiftags
 
@@ -12,51 +15,126 @@ format for the DateTime tag in the EXIF data.
 """
 
 
+# same set of files guess_type() would report as images
+mimetypes.init()
+IMAGE_EXTS = frozenset(
+    ext.lower()
+    for ext, type_ in mimetypes.types_map.items()
+    if type_.startswith("image/")
+)
+JPEG_EXTS = frozenset({".jpg", ".jpeg"})
+
+# plain int tags, so the lookups below skip the IntEnum attribute access
+SOFTWARE = int(exiftags.Base.Software)
+DATE_TIME = int(exiftags.Base.DateTime)
+
+
+def find_exif_segment(fp: BinaryIO) -> tuple[int, bytes] | None:
+    """
+    Find the APP1 EXIF segment of a JPEG by reading only the markers before it.
+    Returns the offset of the segment and its payload.
+    """
+    if fp.read(2) != b"\xff\xd8":
+        return None
+
+    while True:
+        offset = fp.tell()
+        marker = fp.read(4)
+        # stop at a malformed marker or the start of the image data
+        if len(marker) < 4 or marker[0] != 0xFF or marker[1] == 0xDA:
+            return None
+
+        size = int.from_bytes(marker[2:], "big") - 2
+        if marker[1] == 0xE1:
+            data = fp.read(size)
+            if data.startswith(b"Exif\x00\x00"):
+                return offset, data
+        else:
+            fp.seek(size, os.SEEK_CUR)
+
+
+def get_exif(f: Path) -> Image.Exif:
+    """
+    Get the EXIF data without opening the image.
+    For JPEGs only the markers up to the APP1 segment are read.
+    Other formats fall back to Pillow.
+    """
+    if f.suffix.lower() not in JPEG_EXTS:
+        with Image.open(f) as img:
+            return img.getexif()
+
+    exif = Image.Exif()
+    with f.open("rb") as fp:
+        segment = find_exif_segment(fp)
+
+    if segment is not None:
+        exif.load(segment[1])
+
+    return exif
+
+
+def save_exif(f: Path, exif: Image.Exif):
+    """
+    Write the EXIF data back to the file.
+    For JPEGs only the APP1 segment is replaced, so the image is not re-encoded.
+    Other formats are re-saved with Pillow.
+    """
+    if f.suffix.lower() not in JPEG_EXTS:
+        with Image.open(f) as img:
+            img.save(f, exif=exif)
+        return
+
+    data = f.read_bytes()
+    segment = find_exif_segment(io.BytesIO(data))
+    if segment is None:
+        start = end = 2  # right after the SOI marker
+    else:
+        start = segment[0]
+        end = start + 4 + len(segment[1])
+
+    payload = exif.tobytes()
+    app1 = b"\xff\xe1" + (len(payload) + 2).to_bytes(2, "big") + payload
+    f.write_bytes(data[:start] + app1 + data[end:])
+
+
+def iter_images(source: Path, recursive: bool) -> Iterator[Path]:
+    # walk with an explicit stack instead of recursing per directory
+    stack: list[str | Path] = [source]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if recursive is True:
+                        stack.append(entry.path)
+                    continue
+
+                if not entry.is_file():
+                    continue
+
+                if os.path.splitext(entry.name)[1].lower() in IMAGE_EXTS:
+                    yield Path(entry.path)
+
+
 def fix_movie_maker_date_time(source: Path, recursive: bool, dry_run: bool):
-    for f in source.iterdir():
-        # Recurse into directories
-        if recursive is True and f.is_dir():
-            fix_movie_maker_date_time(source=f, recursive=recursive, dry_run=dry_run)
+    for f in iter_images(source, recursive):
+        exif = get_exif(f)
 
-        if not f.is_file():
+        if "Movie Maker" not in exif.get(SOFTWARE, ""):
             continue
 
-        type_, _ = mimetypes.guess_type(f)
-        if type_ is None:
+        original = exif.get(DATE_TIME)
+        if original is None:
             continue
 
-        if not type_.startswith("image"):
-            continue
+        try:
+            datetime.strptime(original, "%Y:%m:%d %H:%M:%S")
+        except ValueError:
+            date_time = datetime.strptime(original[:24], "%a %b %d %H:%M:%S %Y")
+            print(f'File: {f.name} - "{original}" => "{date_time}"')
 
-        with Image.open(f) as img:
-            exif = img.getexif()
-
-            if "Movie Maker" not in exif.get(exiftags.Base.Software, ""):
-                continue
-
-            if exiftags.Base.DateTime not in exif:
-                continue
-
-            try:
-                datetime.strptime(
-                    exif[exiftags.Base.DateTime],
-                    "%Y:%m:%d %H:%M:%S",
-                )
-            except ValueError:
-                date_string = exif[exiftags.Base.DateTime]
-                if len(date_string) > 24:
-                    date_string = date_string[:24]
-
-                date_time = datetime.strptime(date_string, "%a %b %d %H:%M:%S %Y")
-                print(
-                    f'File: {f.name} - "{exif[exiftags.Base.DateTime]}" => "{date_time}"'
-                )
-
-                if dry_run is False:
-                    exif[exiftags.Base.DateTime] = date_time.strftime(
-                        "%Y:%m:%d %H:%M:%S"
-                    )
-                    img.save(f, exif=exif)
+            if dry_run is False:
+                exif[DATE_TIME] = date_time.strftime("%Y:%m:%d %H:%M:%S")
+                save_exif(f, exif)
 
 
 if __name__ == "__main__":
@@ -1,14 +1,39 @@
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+import errno
+from functools import lru_cache
 import json
 import mimetypes
+import os
 from pathlib import Path
+import shutil
+from stat import S_ISREG
 import subprocess
-from typing import NamedTuple
+from typing import Iterator, NamedTuple
 
 from PIL import Image as image, ExifTags as exif_tags
 
 
+# every extension the mimetypes database maps to an image type, worked out once
+# at import so the walk is a plain set lookup rather than a guess_type() call
+mimetypes.init()
+IMAGE_EXTS = frozenset(
+    ext.lower()
+    for ext, type_ in mimetypes.types_map.items()
+    if type_.startswith("image/")
+)
+VIDEO_EXTS = frozenset(
+    ext.lower()
+    for ext, type_ in mimetypes.types_map.items()
+    if type_.startswith("video/")
+)
+JPEG_EXTS = frozenset({".jpg", ".jpeg"})
+QUICKTIME_EXTS = frozenset({".mov", ".qt", ".mp4", ".m4v", ".3gp"})
+
+COPY_CHUNK_SIZE = 1024 * 1024
+READ_BUFFER_SIZE = 64 * 1024
+
 
 class ExifData(NamedTuple):
     date_time: datetime | None = None
@@ -34,14 +59,137 @@ class ExifData(NamedTuple):
         return self.make is not None and self.model is not None
 
 
-def get_data_via_exiftool(f: Path) -> ExifData:
+@lru_cache(maxsize=4096)
+def parse_exif_date_time(value: str) -> datetime:
+    """
+    Parse an EXIF "YYYY:MM:DD HH:MM:SS" date.
+    Swapping the date separators makes it ISO 8601, which fromisoformat parses
+    far faster than strptime. strptime is only used for anything else.
+    """
+    try:
+        date_time = datetime.fromisoformat(value.replace(":", "-", 2))
+    except ValueError:
+        return datetime.strptime(value, "%Y:%m:%d %H:%M:%S")
+
+    # some files include a UTC offset, keep everything naive so dates compare
+    return date_time.replace(tzinfo=None)
+
+
+class ExifToolSession:
+    """
+    A single exiftool process kept open with -stay_open, so the Perl
+    interpreter is only started once rather than for every call.
+    The process is started on first use.
+    """
+
+    def __init__(self):
+        self._process: subprocess.Popen | None = None
+        self._count = 0
+
+    def __enter__(self) -> "ExifToolSession":
+        return self
+
+    def __exit__(self, *args):
+        if self._process is None:
+            return
+
+        # tell exiftool to exit so that no process is left behind
+        self._process.stdin.write(b"-stay_open\nFalse\n")
+        self._process.stdin.close()
+        self._process.wait()
+        self._process = None
+
+    def execute(self, *args: str) -> bytes:
+        """
+        Run exiftool with the given arguments and return its raw output.
+        The output is left as bytes, json.loads reads those directly.
+        """
+        if self._process is None:
+            self._process = subprocess.Popen(
+                ["exiftool", "-stay_open", "True", "-@", "-"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+            )
+
+        self._count += 1
+        command = "\n".join(args) + f"\n-execute{self._count}\n"
+        self._process.stdin.write(os.fsencode(command))
+        self._process.stdin.flush()
+
+        # the output of each command ends with a {ready<N>} line
+        ready = f"{{ready{self._count}}}\n".encode()
+        lines: list[bytes] = []
+        while (line := self._process.stdout.readline()) != ready:
+            if not line:
+                raise RuntimeError("exiftool exited unexpectedly.")
+            lines.append(line)
+
+        return b"".join(lines)
+
+
+def has_gps_quick(f: str) -> bool:
+    """
+    Check whether a video could have a location without running exiftool.
+    For QuickTime and MP4 files the top level atoms are walked and the moov
+    atom is searched for the location tags that phones write, or for XMP.
+    Any top level uuid or meta atom may hold XMP too, so those count as a
+    maybe. Returns True whenever it cannot tell.
+    """
+    if os.path.splitext(f)[1].lower() not in QUICKTIME_EXTS:
+        return True
+
+    moov_has_gps: bool | None = None
+    with open(f, "rb") as fp:
+        while len(header := fp.read(8)) == 8:
+            size = int.from_bytes(header[:4], "big")
+            header_size = 8
+            if size == 1:
+                # the real size follows as a 64 bit integer
+                size = int.from_bytes(fp.read(8), "big")
+                header_size = 16
+
+            atom_type = header[4:]
+            if atom_type in (b"uuid", b"meta"):
+                return True
+
+            if atom_type == b"moov":
+                body = fp.read(size - header_size) if size else fp.read()
+                # udta/\xa9xyz, the com.apple.quicktime.location.ISO6709 key,
+                # or XMP (udta/XMP_ in MOV) which exiftool also reads GPS from
+                moov_has_gps = any(
+                    tag in body
+                    for tag in (b"\xa9xyz", b"ISO6709", b"XMP_", b"GPSLatitude")
+                )
+                if moov_has_gps or not size:
+                    break
+
+                # keep walking, a uuid atom with XMP can come after moov
+                continue
+
+            # a size of 0 means the atom runs to the end of the file
+            if size < header_size:
+                break
+
+            fp.seek(size - header_size, os.SEEK_CUR)
+
+    # without a moov atom there is nothing to rule the file out with
+    return moov_has_gps is not False
+
+
+def get_data_via_exiftool(
+    exiftool: ExifToolSession, files: list[str]
+) -> dict[str, ExifData]:
     """
     Get the dates from the EXIF data using exiftool.
     exiftool supports getting data for videos as well.
-    The downside is that it is really slow.
+    The downside is that it is really slow to start, so all of the files
+    are read by one command of a long running exiftool process.
     """
-    cmd = [
-        "exiftool",
+    if not files:
+        return {}
+
+    output = exiftool.execute(
         "-j",
         "-n",
         "-DateTimeOriginal",
@@ -51,100 +199,233 @@ def get_data_via_exiftool(f: Path) -> ExifData:
         "-GPSLongitude",
         "-Make",
         "-Model",
+        # not -fast2, which stops at the mdat atom and so misses the metadata
+        # of videos that store moov after it
         "-fast",
-        str(f),
-    ]
-    completed_process = subprocess.run(cmd, capture_output=True, text=True)
+        "-api",
+        "largefilesupport=1",
+        # ignore minor errors, and leave out warnings and the summary line
+        "-m",
+        "-q",
+        "-q",
+        *files,
+    )
     try:
-        output = json.loads(completed_process.stdout)[0]
+        outputs = json.loads(output)
     except json.JSONDecodeError:
-        return ExifData()
-
-    date_time = output.get("ModifyDate", None)
-    if date_time is not None:
-        date_time = datetime.strptime(date_time, "%Y:%m:%d %H:%M:%S")
+        return {}
+
+    results: dict[str, ExifData] = {}
+    for output in outputs:
+        date_time = output.get("ModifyDate", None)
+        if date_time is not None:
+            date_time = parse_exif_date_time(date_time)
+
+        date_time_original = output.get("DateTimeOriginal", None)
+        if date_time_original is not None:
+            date_time_original = parse_exif_date_time(date_time_original)
+
+        date_time_digitized = output.get("CreateDate", None)
+        if date_time_digitized is not None:
+            date_time_digitized = parse_exif_date_time(date_time_digitized)
+
+        # exiftool writes paths with forward slashes on every platform
+        results[os.path.normpath(output["SourceFile"])] = ExifData(
+            date_time=date_time,
+            date_time_original=date_time_original,
+            date_time_digitized=date_time_digitized,
+            gps_latitude=output.get("GPSLatitude", None),
+            gps_longitude=output.get("GPSLongitude", None),
+            make=output.get("Make", None),
+            model=output.get("Model", None),
+        )
 
-    date_time_original = output.get("DateTimeOriginal", None)
-    if date_time_original is not None:
-        date_time_original = datetime.strptime(date_time_original, "%Y:%m:%d %H:%M:%S")
+    return results
 
-    date_time_digitized = output.get("CreateDate", None)
-    if date_time_digitized is not None:
-        date_time_digitized = datetime.strptime(
-            date_time_digitized, "%Y:%m:%d %H:%M:%S"
-        )
 
-    return ExifData(
-        date_time=date_time,
-        date_time_original=date_time_original,
-        date_time_digitized=date_time_digitized,
-        gps_latitude=output.get("GPSLatitude", None),
-        gps_longitude=output.get("GPSLongitude", None),
-        make=output.get("Make", None),
-        model=output.get("Model", None),
-    )
+def get_exif(f: str) -> image.Exif:
+    """
+    Get the EXIF data without opening the image.
+    For JPEGs only the markers up to the APP1 segment are read, then Pillow
+    parses just those bytes. Other formats are opened with Pillow.
+    """
+    # one read fills the buffer with the start of the file, which is where
+    # the metadata lives for almost every format
+    with open(f, "rb", buffering=READ_BUFFER_SIZE) as fp:
+        if os.path.splitext(f)[1].lower() not in JPEG_EXTS:
+            with image.open(fp) as img:
+                return img.getexif()
+
+        exif = image.Exif()
+        if fp.read(2) != b"\xff\xd8":
+            return exif
+
+        while True:
+            marker = fp.read(4)
+            # stop at a malformed marker or the start of the image data
+            if len(marker) < 4 or marker[0] != 0xFF or marker[1] == 0xDA:
+                return exif
+
+            size = int.from_bytes(marker[2:], "big") - 2
+            if marker[1] == 0xE1:
+                data = fp.read(size)
+                if data.startswith(b"Exif\x00\x00"):
+                    exif.load(data)
+                    return exif
+            else:
+                fp.seek(size, os.SEEK_CUR)
 
 
-def get_data_via_pillow(f: Path) -> ExifData:
+def get_data_via_pillow(f: str) -> ExifData:
     """
     Get the dates from the EXIF data using Pillow.
     Pillow only supports images.
     """
-    with image.open(f) as img:
-        exif = img.getexif()
+    exif = get_exif(f)
 
-    basic_data = {exif_tags.TAGS[k]: v for k, v in exif.items() if k in exif_tags.TAGS}
+    # look up only the tags that are needed, by id, rather than naming every tag
     try:
-        exif_data = {
-            exif_tags.TAGS[k]: v
-            for k, v in exif.get_ifd(exif_tags.IFD.Exif).items()
-            if k in exif_tags.TAGS
-        }
+        exif_ifd = exif.get_ifd(exif_tags.IFD.Exif)
     except ValueError as e:
         print(f"Error: {e}, {f}")
-        exif_data = {}
+        exif_ifd = {}
 
-    gps_info = {
-        exif_tags.GPSTAGS[k]: v
-        for k, v in exif.get_ifd(exif_tags.IFD.GPSInfo).items()
-        if k in exif_tags.GPSTAGS
-    }
+    gps_ifd = exif.get_ifd(exif_tags.IFD.GPSInfo)
 
-    date_time = basic_data.get("DateTime", None)
+    date_time = exif.get(exif_tags.Base.DateTime, None)
     if date_time is not None:
-        date_time = datetime.strptime(date_time, "%Y:%m:%d %H:%M:%S")
+        date_time = parse_exif_date_time(date_time)
 
-    date_time_original = exif_data.get("DateTimeOriginal", None)
+    date_time_original = exif_ifd.get(exif_tags.Base.DateTimeOriginal, None)
     if date_time_original is not None:
-        date_time_original = datetime.strptime(date_time_original, "%Y:%m:%d %H:%M:%S")
+        date_time_original = parse_exif_date_time(date_time_original)
 
-    date_time_digitized = exif_data.get("DateTimeDigitized", None)
+    date_time_digitized = exif_ifd.get(exif_tags.Base.DateTimeDigitized, None)
     if date_time_digitized is not None:
-        date_time_digitized = datetime.strptime(
-            date_time_digitized, "%Y:%m:%d %H:%M:%S"
-        )
+        date_time_digitized = parse_exif_date_time(date_time_digitized)
 
     return ExifData(
         date_time=date_time,
         date_time_original=date_time_original,
         date_time_digitized=date_time_digitized,
-        gps_latitude=gps_info.get("GPSLatitude", None),
-        gps_longitude=gps_info.get("GPSLongitude", None),
-        make=basic_data.get("Make", None),
-        model=basic_data.get("Model", None),
+        gps_latitude=gps_ifd.get(exif_tags.GPS.GPSLatitude, None),
+        gps_longitude=gps_ifd.get(exif_tags.GPS.GPSLongitude, None),
+        make=exif.get(exif_tags.Base.Make, None),
+        model=exif.get(exif_tags.Base.Model, None),
     )
 
 
-def get_dates_via_stat(f: Path) -> list[datetime]:
+@lru_cache(maxsize=4096)
+def date_time_from_timestamp(timestamp: float) -> datetime:
+    # files copied or extracted together often share a timestamp
+    return datetime.fromtimestamp(timestamp)
+
+
+def get_min_stat_date(stat: os.stat_result) -> datetime:
+    """
+    Get the earliest date from the file system using stat.
+    Only the smallest timestamp is converted, rather than all three.
     """
-    Get the dates from the file system using stat.
+    return date_time_from_timestamp(min(stat.st_atime, stat.st_ctime, stat.st_mtime))
+
+
+def move_file(src: str, dst: str):
+    """
+    Move a file, renaming it in place when it stays on the same filesystem.
+    Otherwise the data is copied with copy_file_range, which keeps it in the
+    kernel (and lets CoW filesystems share extents), then the source is removed.
+    An existing destination is never overwritten.
+    """
+    # rename replaces an existing file, so check first like "xb" does below
+    if os.path.lexists(dst):
+        raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), dst)
+
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    with open(src, "rb") as fsrc, open(dst, "xb") as fdst:
+        try:
+            while os.copy_file_range(fsrc.fileno(), fdst.fileno(), COPY_CHUNK_SIZE):
+                pass
+        except (AttributeError, OSError):
+            # not available on this platform or between these filesystems,
+            # carry on from wherever copy_file_range stopped
+            shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+
+    shutil.copystat(src, dst)
+    os.unlink(src)
+
+
+def iter_media_files(
+    source: Path, recursive: bool
+) -> Iterator[tuple[str, os.stat_result]]:
+    # os.walk lists symlinked directories but does not descend into them,
+    # which also keeps the walk out of link loops
+    for root, dirs, files in os.walk(os.path.normpath(source)):
+        if recursive is False:
+            dirs.clear()
+
+        for name in files:
+            # Skip files that are not images or videos
+            suffix = os.path.splitext(name)[1].lower()
+            if suffix not in IMAGE_EXTS and suffix not in VIDEO_EXTS:
+                continue
+
+            path = os.path.join(root, name)
+            stat = os.lstat(path)
+            # symlinks and other special files are left alone
+            if not S_ISREG(stat.st_mode):
+                continue
+
+            yield path, stat
+
+
+def format_date_string(date_time: datetime) -> str:
     """
-    stat = f.stat()
-    return [
-        datetime.fromtimestamp(stat.st_atime),
-        datetime.fromtimestamp(stat.st_ctime),
-        datetime.fromtimestamp(stat.st_mtime),
-    ]
+    Format a date as YYYY-MM-DD_HH-MM-SS for a file name, in one step rather
+    than building the ISO format and then replacing its colons.
+    """
+    return "%04d-%02d-%02d_%02d-%02d-%02d" % (
+        date_time.year,
+        date_time.month,
+        date_time.day,
+        date_time.hour,
+        date_time.minute,
+        date_time.second,
+    )
+
+
+def get_taken_names(year_dir: str) -> dict[str, int]:
+    """
+    Map each file name already in the directory, without its number, to the
+    highest number in use for it. A name without a number counts as 0.
+    Extensions are lowercased like the new names, so an existing .JPG still
+    reserves its name on case-insensitive filesystems.
+    """
+    taken: dict[str, int] = {}
+    try:
+        with os.scandir(year_dir) as it:
+            for entry in it:
+                stem, ext = os.path.splitext(entry.name)
+                ext = ext.lower()
+                parts = stem.split("_")
+                if len(parts) == 2:
+                    name, n = f"{stem}{ext}", 0
+                elif len(parts) == 3 and parts[2].isdigit():
+                    name, n = f"{parts[0]}_{parts[1]}{ext}", int(parts[2])
+                else:
+                    continue
+
+                taken[name] = max(n, taken.get(name, 0))
+
+    except FileNotFoundError:
+        pass
+
+    return taken
 
 
 def rename_files(
@@ -153,77 +434,76 @@ def rename_files(
     recursive: bool,
     gps_only: bool,
     camera_only: bool,
-    dry_run: bool
+    dry_run: bool,
+    exiftool: ExifToolSession,
 ):
-    for f in source.iterdir():
-        # Recurse into directories
-        if recursive is True and f.is_dir():
-            rename_files(
-                source=f,
-                destination=destination,
-                recursive=recursive,
-                gps_only=gps_only,
-                camera_only=camera_only,
-                dry_run=dry_run,
-            )
-
-        if not f.is_file():
-            continue
-
-        # Skip files that are not images or videos
-        type_, _ = mimetypes.guess_type(f)
-        if type_ is None:
-            continue
-
-        if not type_.startswith("image") and not type_.startswith("video"):
-            continue
-
+    media_files = dict(iter_media_files(source, recursive))
+    images = [f for f in media_files if os.path.splitext(f)[1].lower() in IMAGE_EXTS]
+    videos = [f for f in media_files if os.path.splitext(f)[1].lower() in VIDEO_EXTS]
+
+    if gps_only is True:
+        # rule out videos without a location before exiftool reads them
+        videos = [f for f in videos if has_gps_quick(f)]
+
+    # Each file's metadata is independent, so the images are read by a pool of
+    # processes while exiftool reads all of the videos
+    with ProcessPoolExecutor() as executor:
+        image_data = executor.map(get_data_via_pillow, images, chunksize=16)
+        exif_data_by_file = get_data_via_exiftool(exiftool, videos)
+        exif_data_by_file.update(zip(images, image_data))
+
+    # the destination directory for each year and the names already taken in
+    # it, worked out once per year rather than per file
+    year_dirs: dict[int, str] = {}
+    taken_names: dict[int, dict[str, int]] = {}
+    # years whose directory has been made, so mkdir runs once per year
+    created_years: set[int] = set()
+
+    # Renaming stays in this process, one file at a time
+    for f, stat in media_files.items():
         # possible add back check for geo-tagging
 
-        if type_.startswith("image"):
-            exif_data = get_data_via_pillow(f)
-        else:
-            exif_data = get_data_via_exiftool(f)
-        
+        exif_data = exif_data_by_file.get(f, ExifData())
+
         if gps_only is True and not exif_data.has_gps_info():
             continue
 
         if camera_only is True and not exif_data.has_camera_info():
             continue
 
+        # Get the minimum time, stat always provides one
         dates = exif_data.get_dates()
-        dates.extend(get_dates_via_stat(f))
-
-        if not dates:
-            print(f"Could not get dates for {f.name}.")
-            continue
-
-        # Get the minimum time
+        dates.append(get_min_stat_date(stat))
         min_date = min(dates)
 
         # Create the new file name
-        date_string = min_date.isoformat("_", "seconds").replace(":", "-")
-        new_name = f"{date_string}{f.suffix.lower()}"
-
-        new_file = destination / str(min_date.year) / new_name
-
-        while new_file.exists():
-            # If the file already exists, add a number to the end of the file name
-            new_name_parts = new_file.stem.split("_")
-            if len(new_name_parts) == 2:
-                new_file = new_file.with_stem(f"{new_file.stem}_1")
-            elif len(new_name_parts) == 3:
-                new_file = new_file.with_stem(
-                    f"{new_name_parts[0]}_{new_name_parts[1]}_{int(new_name_parts[2]) + 1}"
-                )
-            else:
-                raise ValueError("Invalid file name.")
+        date_string = format_date_string(min_date)
+        suffix = os.path.splitext(f)[1].lower()
+        new_name = f"{date_string}{suffix}"
+
+        year_dir = year_dirs.get(min_date.year)
+        if year_dir is None:
+            year_dir = os.path.join(destination, str(min_date.year))
+            year_dirs[min_date.year] = year_dir
+            taken_names[min_date.year] = get_taken_names(year_dir)
+
+        # If the name is already taken, add the next number to the end of it
+        taken = taken_names[min_date.year]
+        n = taken.get(new_name)
+        taken[new_name] = 0 if n is None else n + 1
+        if n is not None:
+            new_name = f"{date_string}_{n + 1}{suffix}"
+
+        new_file = os.path.join(year_dir, new_name)
 
         print(f"{f} -> {new_file}")
 
         if dry_run is False:
-            new_file.parent.mkdir(parents=True, exist_ok=True)  # create the parent directories
-            f.rename(new_file)  # move the file to the destination
+            if min_date.year not in created_years:
+                os.makedirs(year_dir, exist_ok=True)
+                created_years.add(min_date.year)
+
+            move_file(f, new_file)
 
 
 if __name__ == "__main__":
@@ -264,11 +544,13 @@ if __name__ == "__main__":
         if result != "yes":
             parser.exit(1)
 
-    rename_files(
-        source=ns.src,
-        destination=ns.dest,
-        recursive=ns.recursive,
-        gps_only=ns.gps_only,
-        camera_only=ns.camera_only,
-        dry_run=ns.dry_run,
-    )
+    with ExifToolSession() as exiftool:
+        rename_files(
+            source=ns.src,
+            destination=ns.dest,
+            recursive=ns.recursive,
+            gps_only=ns.gps_only,
+            camera_only=ns.camera_only,
+            dry_run=ns.dry_run,
+            exiftool=exiftool,
+        )
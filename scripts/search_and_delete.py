@@ -1,21 +1,64 @@
 from argparse import ArgumentParser
+import os
 from pathlib import Path
+import re
 
 
-def search_and_delete(source: Path, term: str, recursive: bool, case_insensitive: bool):
-    for f in source.iterdir():
-        if recursive is True and f.is_dir():
-            search_and_delete(source=f, term=term, recursive=recursive)
+def find_matches(source: Path, pattern: re.Pattern[str], recursive: bool) -> list[str]:
+    matches: list[str] = []
 
-        if not f.is_file():
-            continue
+    # walk with an explicit stack; symlinks are neither followed nor deleted
+    stack: list[str | Path] = [source]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive is True:
+                        stack.append(entry.path)
+                    continue
 
-        if (not case_insensitive and term in f.name) or (
-            case_insensitive and term.lower() in f.name.lower()
-        ):
-            result = input(f"Delete file {f.name}? [y/n]: ")
-            if result == "y":
-                f.unlink()
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+
+                if pattern.search(entry.name):
+                    matches.append(entry.path)
+
+    return matches
+
+
+def confirm_and_delete(matches: list[str], assume_yes: bool):
+    """
+    Ask once before deleting all of the matches, or choose file by file.
+    """
+    if not matches:
+        print("No matching files.")
+        return
+
+    if assume_yes is False:
+        print("\n".join(matches))
+        result = input(f"Delete {len(matches)} files? [y/n/choose]: ")
+        if result == "choose":
+            matches = [m for m in matches if input(f"Delete file {m}? [y/n]: ") == "y"]
+        elif result != "y":
+            return
+
+    for path in matches:
+        os.unlink(path)
+
+
+def search_and_delete(
+    source: Path,
+    term: str,
+    recursive: bool,
+    case_insensitive: bool,
+    assume_yes: bool,
+):
+    # compile the term once, rather than lowering it again for every file
+    flags = re.IGNORECASE if case_insensitive else 0
+    pattern = re.compile(re.escape(term), flags)
+
+    matches = find_matches(source, pattern, recursive)
+    confirm_and_delete(matches, assume_yes)
 
 
 if __name__ == "__main__":
@@ -24,6 +67,7 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--src", type=Path, default=Path.cwd())
     parser.add_argument("-r", "--recursive", action="store_true")
     parser.add_argument("-i", "--case-insensitive", action="store_true")
+    parser.add_argument("-y", "--assume-yes", action="store_true")
     ns = parser.parse_args()
 
     if len(ns.term) < 3:
@@ -37,4 +81,5 @@ if __name__ == "__main__":
         term=ns.term,
         recursive=ns.recursive,
         case_insensitive=ns.case_insensitive,
+        assume_yes=ns.assume_yes,
     )